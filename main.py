@@ -1,8 +1,21 @@
+from __future__ import annotations
+
 import praw
+import prawcore
+import argparse
+import itertools
 import os
-import sys
+import re
+import shutil
+import tempfile
 import logging
-from openpyxl.utils.exceptions import InvalidFileException
+import math
+import zipfile
+from collections import defaultdict
+from operator import itemgetter
+from xml.sax.saxutils import escape, quoteattr
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils.exceptions import IllegalCharacterError, InvalidFileException
 from openpyxl import Workbook, load_workbook
 from dotenv import load_dotenv
 load_dotenv(dotenv_path=".env")
@@ -12,22 +25,98 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+_REDDIT_URL_RE = re.compile(
+    r"^https?://(?:(?:[\w-]+\.)*reddit\.com/(?:(?:r|u|user)/[^/]+/)?(?:comments|gallery)/|redd\.it/)"
+    r"(?P<id>[a-z0-9]+)(?=[/?#]|$)", re.IGNORECASE)
+# Reddit's /api/info endpoint accepts up to 100 fullnames per call
+_INFO_BATCH_SIZE = 100
+_HEADER = ("URL", "Number of comments", "Traffic")
+
+# Minimal SpreadsheetML parts used by the fast writer
+_XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_CONTENT_TYPES = (
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '{overrides}</Types>')
+_SHEET_CONTENT_TYPE = (
+    '<Override PartName="/xl/worksheets/sheet{n}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+_ROOT_RELS = (
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="xl/workbook.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>')
+_WORKBOOK = (
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets></workbook>')
+_WORKBOOK_SHEET = '<sheet name={name} sheetId="{n}" r:id="rId{n}"/>'
+_WORKBOOK_RELS = (
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '{rels}</Relationships>')
+_WORKBOOK_SHEET_REL = (
+    '<Relationship Id="rId{n}" Target="worksheets/sheet{n}.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>')
+_WORKSHEET = (
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetData>{rows}</sheetData></worksheet>')
+
+
+def _credentials_from_env():
+    # CLIENT_ID/CLIENT_SECRET/USER_AGENT, then CLIENT_ID_2, CLIENT_ID_3, ... for each extra Reddit app
+    credentials = []
+    for suffix in itertools.chain([""], (f"_{n}" for n in itertools.count(2))):
+        client_id = os.getenv(f"CLIENT_ID{suffix}")
+        if suffix and not client_id:
+            break
+        credentials.append({
+            "client_id": client_id,
+            "client_secret": os.getenv(f"CLIENT_SECRET{suffix}"),
+            "user_agent": os.getenv(f"USER_AGENT{suffix}"),
+        })
+    return credentials
+
 
 class RedditAPIClient:
-    def __init__(self, read_file_path, write_file_path):
-        self.reddit = praw.Reddit(
-            client_id=os.getenv("CLIENT_ID"),
-            client_secret=os.getenv("CLIENT_SECRET"),
-            user_agent=os.getenv("USER_AGENT"),
-        )
-        self.xlsxclient = ExcelHandler(read_file_path, write_file_path)
-
-    def get_submission_comments(self, submission_url: str, traffic: str):
-        submission = self.reddit.submission(url=submission_url)
-        if submission.locked or submission.archived:
-            return
-        comments_count = len(submission.comments)
-        self._write_comments_to_excel(submission_url, comments_count, traffic)
+    __slots__ = ("reddits", "_reddit_cycle", "xlsxclient")
+
+    def __init__(self, read_file_path, write_file_path, credentials: list[dict] | None = None,
+                 fast_writer: bool = False):
+        if credentials is None:
+            credentials = _credentials_from_env()
+        # Each Reddit app has its own rate limit, so requests are spread across all of them
+        self.reddits = [praw.Reddit(**c) for c in credentials]
+        self._reddit_cycle = itertools.cycle(self.reddits)
+        self.xlsxclient = ExcelHandler(read_file_path, write_file_path, fast_writer)
+
+    def get_submissions_comments(self, batch: dict):
+        try:
+            self._fetch_batch(batch)
+        except (praw.exceptions.PRAWException, prawcore.exceptions.PrawcoreException) as e:
+            # Keep going so the submissions fetched so far still reach the output file
+            logger.error(f"Error fetching {len(batch)} submissions from Reddit: {e}")
+            return False
+        return True
+
+    def _fetch_batch(self, batch: dict):
+        reddit = next(self._reddit_cycle)
+        found = set()
+        for submission in reddit.info(fullnames=list(batch)):
+            found.add(submission.fullname)
+            if submission.locked or submission.archived:
+                continue
+            if submission.num_comments > 3:
+                continue
+            for submission_url, traffic in batch.get(submission.fullname, []):
+                self._write_comments_to_excel(submission_url, submission.num_comments, traffic)
+        for fullname, rows in batch.items():
+            if fullname in found:
+                continue
+            for submission_url, _ in rows:
+                logger.warning(f"Submission not found: {submission_url}")
 
     def _write_comments_to_excel(self, submission_url: str, comments_count: int, traffic: str):
         if comments_count == 0:
@@ -36,31 +125,68 @@ class RedditAPIClient:
             self.xlsxclient.write_data_to_sheet([submission_url, comments_count, traffic], "3 or less comments")
 
     def run(self, skip_header: bool = True):
-        data = self.xlsxclient.read_data()
-        if data is None:
+        rows = self.xlsxclient.read_data(min_row=2 if skip_header else 1)
+        if rows is None:
             return
-        for sheet_name, sheet_data in data.items():
-            for index, row in enumerate(sheet_data):
-                if skip_header and index == 0:
-                    continue
-                url, traffic = row
-                self.get_submission_comments(url, traffic)
-                logger.info(f"Processed: row {index} in sheet {sheet_name}")
-        self.xlsxclient.sort_output_by_traffic()
-        logger.info("Processing complete!")
+        processed = 0
+        failed = 0
+        for batch in self._iter_batches(rows):
+            if self.get_submissions_comments(batch):
+                processed += len(batch)
+            else:
+                failed += len(batch)
+            logger.info(f"Processed {processed} submissions")
+        self.xlsxclient.flush()
+        if self.xlsxclient.read_failed:
+            logger.error(f"Processing incomplete! The input file could not be read to the end; "
+                         f"{processed} submissions processed.")
+        elif failed:
+            logger.error(f"Processing incomplete! {processed} submissions processed, "
+                         f"{failed} could not be fetched.")
+        else:
+            logger.info(f"Processing complete! {processed} submissions processed.")
+
+    def _iter_batches(self, rows):
+        # Groups rows by submission fullname into batches of up to _INFO_BATCH_SIZE ids
+        batch = {}
+        for sheet_name, index, url, traffic in rows:
+            if url is None:
+                continue
+            match = _REDDIT_URL_RE.match(url) if isinstance(url, str) else None
+            if match is None:
+                logger.warning(f"Skipping invalid submission URL: {url}")
+                continue
+            # Output sheets are sorted by traffic, so it has to be a number
+            if isinstance(traffic, bool) or not isinstance(traffic, (int, float)):
+                logger.warning(f"Skipping row {index} in sheet {sheet_name}: invalid traffic {traffic!r}")
+                continue
+            batch.setdefault(f"t3_{match['id'].lower()}", []).append((url, traffic))
+            logger.debug("Queued: row %s in sheet %s", index, sheet_name)
+            if len(batch) == _INFO_BATCH_SIZE:
+                yield batch
+                batch = {}
+        if batch:
+            yield batch
 
 
 class ExcelHandler:
-    def __init__(self, read_file_path, write_file_path):
+    __slots__ = ("read_file_path", "write_file_path", "fast_writer",
+                 "read_workbook", "read_failed", "write_workbook", "_pending")
+
+    def __init__(self, read_file_path, write_file_path, fast_writer: bool = False):
         self.read_file_path = read_file_path
         self.write_file_path = write_file_path
+        self.fast_writer = fast_writer
         self.read_workbook = None
-        self.write_workbook = Workbook()
+        self.read_failed = False
+        self.write_workbook = None if fast_writer else Workbook(write_only=True)
+        self._pending: dict[str, list[tuple]] = defaultdict(list)
 
-    def read_data(self):
+    def read_data(self, min_row: int = 1):
         try:
-            self.read_workbook = load_workbook(self.read_file_path)
-            return self._extract_data_from_workbook()
+            self.read_workbook = load_workbook(
+                self.read_file_path, read_only=True, data_only=True)
+            return self.iter_rows(min_row)
         except FileNotFoundError:
             logger.error(f"Error: File '{self.read_file_path}' not found.")
         except InvalidFileException:
@@ -69,47 +195,116 @@ class ExcelHandler:
         except Exception as e:
             logger.error(f"Error reading file: {e}")
 
-    def _extract_data_from_workbook(self):
-        data = {}
-        for sheet_name in self.read_workbook.sheetnames:
-            sheet = self.read_workbook[sheet_name]
-            data[sheet_name] = [
-                [cell.value for cell in row] for row in sheet.iter_rows()
-            ]
-        return data
+    def iter_rows(self, min_row: int = 1):
+        try:
+            for sheet_name in self.read_workbook.sheetnames:
+                sheet = self.read_workbook[sheet_name]
+                # The <dimension> tag can be missing or wrong, so size the sheet from its rows
+                sheet.reset_dimensions()
+                rows = sheet.iter_rows(min_row=min_row, max_col=2, values_only=True)
+                for index, (url, traffic) in enumerate(rows, start=min_row):
+                    yield sheet_name, index, url, traffic
+        except Exception as e:
+            # Stop reading but let run() write out what was already collected
+            logger.error(f"Error reading file: {e}")
+            self.read_failed = True
+        finally:
+            self.read_workbook.close()
 
     def write_data_to_sheet(self, row_data: list, sheet_name):
-        sheet = self._get_or_create_sheet(sheet_name)
-        sheet.append(row_data)
-        self.write_workbook.save(self.write_file_path)
+        self._pending[sheet_name].append(tuple(row_data))
 
-    def _get_or_create_sheet(self, sheet_name):
-        if sheet_name in self.write_workbook.sheetnames:
-            return self.write_workbook[sheet_name]
-        else:
+    def flush(self):
+        # Rows are sorted before they reach the workbook, since write-only sheets can't be edited
+        sheets = {
+            sheet_name: self._sort_sheet_data_by_traffic(rows)
+            for sheet_name, rows in self._pending.items()
+        }
+        if self.fast_writer:
+            self._save_workbook(lambda path: _write_xlsx(path, sheets))
+            return
+        for sheet_name, rows in sheets.items():
             sheet = self.write_workbook.create_sheet(sheet_name)
-            sheet.append(["URL", "Number of comments", "Traffic"])
-            return sheet
+            sheet.append(_HEADER)
+            for row in rows:
+                sheet.append(row)
+        if not sheets:
+            # A workbook must contain at least one sheet to be valid
+            self.write_workbook.create_sheet()
+        self._save_workbook(self.write_workbook.save)
+
+    def _save_workbook(self, save):
+        # Save next to the target and move it into place, so a failed save never leaves a partial file
+        directory = os.path.dirname(os.path.abspath(self.write_file_path))
+        fd, temp_path = tempfile.mkstemp(suffix=".xlsx", dir=directory)
+        os.close(fd)
+        try:
+            save(temp_path)
+            # mkstemp creates the file as 0600; keep the mode of the file being replaced,
+            # or give a new file the permissions a normal save would
+            if os.path.exists(self.write_file_path):
+                shutil.copymode(self.write_file_path, temp_path)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(temp_path, 0o666 & ~umask)
+            os.replace(temp_path, self.write_file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _sort_sheet_data_by_traffic(self, rows):
+        return sorted(rows, key=itemgetter(2), reverse=True)
+
 
-    def sort_output_by_traffic(self):
-        for sheet_name in self.write_workbook.sheetnames:
-            sheet = self.write_workbook[sheet_name]
-            sorted_data = self._sort_sheet_data_by_traffic(sheet)
-            self._replace_sheet_data(sheet, sorted_data)
-        self.write_workbook.save(self.write_file_path)
+def _xlsx_cell(value):
+    if value is None:
+        return "<c/>"
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value):
+            raise ValueError(f"Cannot write non-finite number {value!r} to an XLSX cell")
+        return f"<c><v>{value}</v></c>"
+    value = str(value)
+    # Same check openpyxl applies, so both writers reject the same input
+    if ILLEGAL_CHARACTERS_RE.search(value):
+        raise IllegalCharacterError(f"{value!r} cannot be used in worksheets.")
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(value)}</t></is></c>'
 
-    def _sort_sheet_data_by_traffic(self, sheet):
-        return sorted(sheet.iter_rows(min_row=2, values_only=True), key=lambda x: x[2], reverse=True)
 
-    def _replace_sheet_data(self, sheet, sorted_data):
-        sheet.delete_rows(2, sheet.max_row)
-        for row in sorted_data:
-            sheet.append(row)
+def _write_xlsx(path, sheets: dict):
+    # Writes the rows of each sheet, header first, as a bare-bones XLSX without going through openpyxl
+    if not sheets:
+        sheets = {"Sheet": None}
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        numbered = list(enumerate(sheets.items(), start=1))
+        zf.writestr("[Content_Types].xml", _XML_DECLARATION + _CONTENT_TYPES.format(
+            overrides="".join(_SHEET_CONTENT_TYPE.format(n=n) for n, _ in numbered)))
+        zf.writestr("_rels/.rels", _XML_DECLARATION + _ROOT_RELS)
+        zf.writestr("xl/workbook.xml", _XML_DECLARATION + _WORKBOOK.format(sheets="".join(
+            _WORKBOOK_SHEET.format(name=quoteattr(sheet_name), n=n)
+            for n, (sheet_name, _) in numbered)))
+        zf.writestr("xl/_rels/workbook.xml.rels", _XML_DECLARATION + _WORKBOOK_RELS.format(
+            rels="".join(_WORKBOOK_SHEET_REL.format(n=n) for n, _ in numbered)))
+        for n, (_, rows) in numbered:
+            xml_rows = []
+            if rows is not None:
+                for r, row in enumerate(itertools.chain([_HEADER], rows), start=1):
+                    xml_rows.append(f'<row r="{r}">{"".join(_xlsx_cell(v) for v in row)}</row>')
+            zf.writestr(f"xl/worksheets/sheet{n}.xml",
+                        _XML_DECLARATION + _WORKSHEET.format(rows="".join(xml_rows)))
 
 
 if __name__ == "__main__":
-    input_read_file_path = sys.argv[1]
-    output_file_path = sys.argv[2]
+    parser = argparse.ArgumentParser(
+        description="Sort Reddit submissions from an Excel file by comment count.")
+    parser.add_argument("input_file", help="Excel file with submission URLs and traffic")
+    parser.add_argument("output_file", help="Excel file to write the results to")
+    parser.add_argument("--fast-writer", action="store_true",
+                        help="write the output XLSX directly instead of through openpyxl")
+    args = parser.parse_args()
     reddit_script = RedditAPIClient(
-        read_file_path=input_read_file_path, write_file_path=output_file_path)
+        read_file_path=args.input_file, write_file_path=args.output_file,
+        fast_writer=args.fast_writer)
     reddit_script.run()